@@ -0,0 +1,120 @@
+"""Hot loop of the fit extraction - appending the fields of data messages to column buffers.
+
+Plain type annotated python, so the module can be compiled with mypyc (see setup.py).
+"""
+
+import math
+import array
+import typing as t
+
+Column: t.TypeAlias = t.Union[array.array, list]
+
+def new_column(value: t.Any, n: int) -> Column:
+    """Creates a column buffer for a field whose first value is value, backfilled with n NAs.
+
+    Numeric fields get a typed array (ints with NAs become floats, as in pandas), other fields a list.
+    """
+    if value is None or type(value) is float:
+        return array.array('d', [math.nan]) * n
+    if type(value) is int:
+        return array.array('q') if not n else array.array('d', [math.nan]) * n
+    return [None] * n
+
+def widen_column(column: Column, value: t.Any) -> Column:
+    """Appends a value that does not fit the typed column, returns the converted column"""
+    if isinstance(column, list):
+        column.append(value)
+        return column
+
+    if column.typecode == 'q' and (value is None or type(value) is float):
+        column = array.array('d', column)
+    if column.typecode == 'd' and (value is None or type(value) is float):
+        column.append(math.nan if value is None else value)
+        return column
+    
+    # Mixed types, back to python objects
+    values = list(column) if column.typecode == 'q' else [None if math.isnan(v) else v for v in column]
+    values.append(value)
+    return values
+
+def append_value(column: Column, value: t.Any) -> Column:
+    """Appends a value to the column, returns the column which may have been converted to fit it"""
+    try:
+        column.append(value)
+    except (TypeError, OverflowError):
+        column = widen_column(column, value)
+    return column
+
+def include_name(name: str, include_unknown: bool) -> bool:
+    """Whether a message or field name is extracted"""
+    return bool(name) and (include_unknown or 'unknown' not in name)
+
+def append_row(
+        values: dict[str, Column],
+        raw_values: dict[str, Column],
+        units: dict[str, str],
+        nonnull_values: set[str],
+        nonnull_raw_values: set[str],
+        include_fields: dict[str, bool],
+        include_unknown: bool,
+        n: int,
+        fields: list) -> bool:
+    """Appends the fields of a data message as row n of the column buffers of its message type.
+
+    Columns are kept aligned: a field missing from a message gets an NA in its column,
+    a field seen for the first time is backfilled with NAs for the previous rows.
+    Fields with a value other than None/NaN are added to the nonnull sets.
+    Returns whether a row was added, messages without any included fields are skipped.
+    """
+    num_added = 0
+    for field in fields:
+        name: str = field.name
+
+        # The name check is done once per field name
+        include = include_fields.get(name)
+        if include is None:
+            include = include_fields[name] = include_name(name, include_unknown)
+        if not include:
+            continue
+
+        value = field.value
+        raw_value = field.raw_value
+        if name not in values:
+            values[name] = new_column(value, n)
+            raw_values[name] = new_column(raw_value, n)
+            units[name] = field.units
+
+        column = values[name]
+        raw_column = raw_values[name]
+        if len(column) > n: # Field repeated in the message, last one wins
+            column.pop()
+            raw_column.pop()
+        else:
+            num_added += 1
+
+        # value == value is False for NaN
+        if name not in nonnull_values and value is not None and value == value:
+            nonnull_values.add(name)
+        if name not in nonnull_raw_values and raw_value is not None and raw_value == raw_value:
+            nonnull_raw_values.add(name)
+
+        try:
+            column.append(value)
+        except (TypeError, OverflowError):
+            values[name] = widen_column(column, value)
+        try:
+            raw_column.append(raw_value)
+        except (TypeError, OverflowError):
+            raw_values[name] = widen_column(raw_column, raw_value)
+
+    if not num_added:
+        return False
+
+    # Pad the columns of fields not in this message
+    if num_added != len(values):
+        for name, column in values.items():
+            if len(column) == n:
+                values[name] = append_value(column, None)
+                raw_values[name] = append_value(raw_values[name], None)
+
+    return True
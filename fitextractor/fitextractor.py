@@ -1,6 +1,7 @@
 
 __all__ = ['FitMessage', 'MessageSummary', 'FitExtractor']
 
+import array
 import datetime
 import hashlib
 import typing as t
@@ -12,7 +13,15 @@ import numpy as np
 
 import fitdecode
 
-Fileish: t.TypeAlias = str | t.BinaryIO
+from ._fitextract_core import Column, include_name, append_row
+
+Fileish: t.TypeAlias = str | bytes | t.BinaryIO
+
+# array typecodes of the numeric column buffers
+COLUMN_DTYPES = {
+    'q': np.int64,
+    'd': np.float64
+}
 
 TYPE_MAP_INCL_PRIO = OrderedDict([
     ('int64', [int]),
@@ -22,13 +31,6 @@ TYPE_MAP_INCL_PRIO = OrderedDict([
     ('datetime64[ns, UTC]', [datetime.datetime])
 ])
 
-@dataclass
-class FitField:
-    name: str
-    value: float
-    raw_value: int
-    unit: str
-
 @dataclass
 class FitMessage:
     name: str
@@ -55,13 +57,26 @@ class FitExtractor:
         # Included in the fit file
         self._header: fitdecode.records.FitHeader = None
         self._crc: fitdecode.records.FitCRC = None
-        self._messages: dict[str, list[list[FitField]]] = {}
+        self._messages: dict[str, dict[str, Column]] = {}
+        self._raw_values: dict[str, dict[str, Column]] = {}
+        self._units: dict[str, dict[str, str]] = {}
+        self._num_rows: dict[str, int] = {}
+        self._nonnull_fields: dict[str, set[str]] = {}
+        self._nonnull_raw_fields: dict[str, set[str]] = {}
+        self._include_fields: dict[str, bool] = {}
 
         # Extra
         self._md5_hash: str = None
         self._summary: MessageSummary = None
+        self._df_cache: dict[tuple[str, str, str | None], pd.DataFrame] = {}
         self._processed: bool = False
 
+    def __getstate__(self) -> dict:
+        """Pickled without the cached dataframes, they are rebuilt from the column buffers when needed"""
+        state = self.__dict__.copy()
+        state['_df_cache'] = {}
+        return state
+
     @property
     def file(self) -> Fileish:
         """Returns the input file"""
@@ -74,10 +89,16 @@ class FitExtractor:
         return self._header
     
     @property
-    def messages(self) -> list[dict]:
-        """Returns the messages from the fitfile"""
+    def messages(self) -> dict[str, dict[str, Column]]:
+        """Returns the messages from the fitfile, as {message_name: {field_name: values}}"""
         self._ensure_processed()
         return self._messages
+
+    @property
+    def units(self) -> dict[str, dict[str, str]]:
+        """Returns the units of the message fields, as {message_name: {field_name: unit}}"""
+        self._ensure_processed()
+        return self._units
     
     @property
     def crc(self) -> fitdecode.records.FitCRC:
@@ -102,12 +123,34 @@ class FitExtractor:
         
         return self._summary
     
-    def _calc_hash(self, chunksize: int = 4096) -> str:
+    def _read_bytes(self) -> bytes:
+        """Reads the whole fitfile in to memory"""
+        if isinstance(self._file, bytes):
+            return self._file
+        if hasattr(self._file, 'read'):
+            # Leave the stream where it was, it can be read again for the blob or a re-parse
+            pos = self._file.tell()
+            data = self._file.read()
+            self._file.seek(pos)
+            return data
+        with open(self._file, "rb") as f:
+            return f.read()
+
+    def _calc_hash(self, chunksize: int = 1 << 20) -> str:
         """Calculates an md5 hash for the fitfile"""
-        hash_md5 = hashlib.md5()
+        if not isinstance(self._file, str):
+            self._md5_hash = hashlib.md5(self._read_bytes()).hexdigest()
+            return self._md5_hash
+
         with open(self._file, "rb") as f:
-            for chunk in iter(lambda: f.read(chunksize), b""):
-                hash_md5.update(chunk)
+            if hasattr(hashlib, 'file_digest'): # Python >= 3.11
+                hash_md5 = hashlib.file_digest(f, 'md5')
+            else:
+                hash_md5 = hashlib.md5()
+                buf = bytearray(chunksize)
+                mv = memoryview(buf)
+                while n := f.readinto(buf):
+                    hash_md5.update(mv[:n])
         self._md5_hash = hash_md5.hexdigest()
         return self._md5_hash
 
@@ -116,8 +159,16 @@ class FitExtractor:
         if not self._file:
             raise Exception('No file specified')
         
+        # Read the file once, for both the hash and the parsing
+        data = self._read_bytes()
+        if self._md5_hash is None:
+            self._md5_hash = hashlib.md5(data).hexdigest()
+
+        # Message name per definition, None if the message is skipped - saves the name lookup and check per frame
+        mesg_names: dict[fitdecode.records.FitDefinitionMessage, str | None] = {}
+
         # Extract messages and more
-        with fitdecode.FitReader(self._file) as fit:
+        with fitdecode.FitReader(data) as fit:
             for frame in fit:
                 
                 if frame.frame_type == fitdecode.FIT_FRAME_HEADER:
@@ -128,15 +179,15 @@ class FitExtractor:
                     pass
                 elif frame.frame_type == fitdecode.FIT_FRAME_DATA:
 
-                    if not self._include_unknown and 'unknown' in frame.name:
-                        continue
-
-                    if frame.name not in self._messages and (frame.name):
-                        self._messages[frame.name] = []
+                    try:
+                        name = mesg_names[frame.def_mesg]
+                    except KeyError:
+                        name = mesg_names[frame.def_mesg] = frame.name if include_name(frame.name, self._include_unknown) else None
+                        if name is not None:
+                            self._add_message(name)
 
-                    fields_clean = [FitField(field.name, field.value, field.raw_value, field.units) for field in frame.fields if ('unknown' not in field.name) or self._include_unknown]
-                    if len(fields_clean):
-                        self._messages[frame.name].append(fields_clean)
+                    if name is not None:
+                        self._append_row(name, frame.fields)
 
                 elif frame.frame_type == fitdecode.FIT_FRAME_DEFMESG:
                     pass
@@ -145,6 +196,32 @@ class FitExtractor:
 
         self._processed = True
 
+    def _add_message(self, mesg_name: str) -> None:
+        """Creates the column buffers of a message type, if not there already"""
+        if mesg_name not in self._messages:
+            self._messages[mesg_name] = {}
+            self._raw_values[mesg_name] = {}
+            self._units[mesg_name] = {}
+            self._nonnull_fields[mesg_name] = set()
+            self._nonnull_raw_fields[mesg_name] = set()
+            self._num_rows[mesg_name] = 0
+
+    def _append_row(self, mesg_name: str, fields: list[fitdecode.types.FieldData]) -> None:
+        """Appends the fields of a data message to the column buffers of its message type, see _add_message"""
+        n = self._num_rows[mesg_name]
+        added = append_row(
+            self._messages[mesg_name],
+            self._raw_values[mesg_name],
+            self._units[mesg_name],
+            self._nonnull_fields[mesg_name],
+            self._nonnull_raw_fields[mesg_name],
+            self._include_fields,
+            self._include_unknown,
+            n,
+            fields)
+        if added:
+            self._num_rows[mesg_name] = n + 1
+
     def _ensure_processed(self) -> None:
         """Helper to call process"""
         if not self._processed:
@@ -183,17 +260,50 @@ class FitExtractor:
 
         return df
     
-    def get_message_df(self, name: str, target_attr: str = 'value') -> pd.DataFrame:
-        """Get a dataframe with the message type name"""
+    def get_message_df(self, name: str, target_attr: str = 'value', dtype_backend: str | None = None) -> pd.DataFrame:
+        """Get a dataframe with the message type name
+
+        dtype_backend is passed on to DataFrame.convert_dtypes, 'pyarrow' gives Arrow backed columns (requires pyarrow).
+        The dataframe is cached and shared between calls, copy it before modifying it in place.
+        """
         self._ensure_processed()
-        if name in self._messages:
-            row_data = [{field.name: getattr(field, target_attr) for field in message_fields} for message_fields in self._messages[name]]
-            df = pd.DataFrame(row_data)
-            df = df.dropna(axis=1, how='all').reset_index(drop=True) # Drop columns with all na -> leads to strange dtypes
-            df = self._clean_df_types(df) # Clean mixed types
+        key = (name, target_attr, dtype_backend)
+        if key in self._df_cache:
+            return self._df_cache[key]
+
+        if dtype_backend is not None:
+            df = self.get_message_df(name, target_attr).convert_dtypes(dtype_backend=dtype_backend)
+            self._df_cache[key] = df
             return df
-        else:
+
+        if name not in self._messages:
             raise Exception(f'{name} not in file messages')
 
+        if target_attr == 'unit':
+            # A field has one unit, repeated over the rows - fields without a unit are all na and left out
+            df = pd.DataFrame({
+                field: [unit] * self._num_rows[name] for field, unit in self._units[name].items() if unit is not None
+            }, index=pd.RangeIndex(self._num_rows[name]))
+            self._df_cache[key] = df
+            return df
+
+        if target_attr == 'value':
+            columns, nonnull_fields = self._messages, self._nonnull_fields
+        elif target_attr == 'raw_value':
+            columns, nonnull_fields = self._raw_values, self._nonnull_raw_fields
+        else:
+            raise Exception(f'{target_attr} is not a message column attribute')
+
+        # Typed arrays are handed to pandas as numpy views, without copying
+        # One 1d array per column, not consolidated in to 2d blocks - the DB writers read contiguous column memory
+        # Columns with all na are left out -> leads to strange dtypes
+        df = pd.DataFrame({
+            field: np.frombuffer(column, dtype=COLUMN_DTYPES[column.typecode]) if isinstance(column, array.array) else column
+            for field, column in columns[name].items() if field in nonnull_fields[name]
+        }, index=pd.RangeIndex(self._num_rows[name]), copy=False)
+        df = self._clean_df_types(df) # Clean mixed types
+        self._df_cache[key] = df
+        return df
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -2,18 +2,113 @@
 
 __all__ = ['MultiFitProcessor']
 
+import io
 import os
+import sys
+import math
+import mmap
 import uuid
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import contextlib
+import collections
+import logging
+import functools
 
 import typing as t
-from multiprocessing import Pool
+import multiprocessing
+import multiprocessing.pool
+from dataclasses import dataclass
 
 import sqlalchemy
+import sqlalchemy.dialects.postgresql
 import pandas as pd
 
-from fitextractor import FitExtractor
+from fitextractor import FitExtractor, MessageSummary
 
 DEFAULT_DB_URL = 'postgresql://postgres@localhost:5432/fitdata'
+INSERT_CHUNKSIZE = 10_000 # Rows per multi-row INSERT statement
+SQLITE_MAX_VARIABLES = 32766 # Default bound variables per statement in sqlite >= 3.32, see _sqlite_max_variables
+SQLITE_OLD_MAX_VARIABLES = 999 # Default before sqlite 3.32
+BLOB_STORAGES = ('db', 'large_object', 'file') # Where the fit file blobs are stored, see to_db
+LOBJECT_CHUNKSIZE = 1 << 20 # Bytes per write to a large object
+SERIAL_MAX_TASKS = 2 # Up to this many tasks are run in process, without the worker pool
+
+# SQL types of the fields, in increasing priority - a field seen with multiple dtypes gets the highest
+SQL_TYPE_PRIORITY = (
+    sqlalchemy.types.Double,
+    sqlalchemy.types.DateTime,
+    sqlalchemy.types.Text,
+    sqlalchemy.types.PickleType
+)
+
+# SQL types by dtype kind, the other kinds (bool, complex, timedelta...) don't count towards a field's type
+KIND_SQL_TYPES = {
+    'i': sqlalchemy.types.Double,
+    'u': sqlalchemy.types.Double,
+    'f': sqlalchemy.types.Double,
+    'M': sqlalchemy.types.DateTime,
+    'U': sqlalchemy.types.Text,
+    'S': sqlalchemy.types.Text,
+    'O': sqlalchemy.types.PickleType
+}
+
+# SQL types of the common dtypes, for fields with a single dtype across all files - same result as KIND_SQL_TYPES
+SINGLE_DTYPE_SQL_TYPES = {
+    'int64': sqlalchemy.types.Double,
+    'float64': sqlalchemy.types.Double,
+    'datetime64[ns, UTC]': sqlalchemy.types.DateTime,
+    'datetime64[us, UTC]': sqlalchemy.types.DateTime,
+    'str': sqlalchemy.types.Text,
+    'object': sqlalchemy.types.PickleType
+}
+
+# fitfiles.blob column per blob storage: the file, its large object oid or its path in the blob_dir
+BLOB_SQL_TYPES = {
+    'db': sqlalchemy.types.LargeBinary,
+    'large_object': sqlalchemy.dialects.postgresql.OID,
+    'file': sqlalchemy.types.Text
+}
+
+logger = logging.getLogger(__name__)
+
+# Engines of the pool workers by (pid, db url), see _get_process_engine
+_process_engines: dict[tuple[int, str], sqlalchemy.Engine] = {}
+
+def _call_star(function_args: tuple[t.Callable, tuple]) -> t.Any:
+    """Unpacks (function, args) for pool methods that pass a single argument"""
+    function, args = function_args
+    return function(*args)
+
+def _get_process_engine(db_url: str) -> sqlalchemy.Engine:
+    """Engine for the db url in a pool worker, kept for the life of the worker. MultiFitProcessors own theirs, see _get_engine.
+
+    Keyed by the pid as well: forked workers inherit the parent's engines, but must not use (or close) its connections.
+    """
+    key = (os.getpid(), db_url)
+    if key not in _process_engines:
+        _process_engines[key] = MultiFitProcessor._create_engine(db_url)
+    return _process_engines[key]
+
+@dataclass
+class ParsedFitFile:
+    """A parsed fit file. From a worker its message dataframes are kept in a pickle file until they are inserted, parsed in process its FitExtractor is kept as is."""
+    file: str
+    md5_hash: str
+    summary: MessageSummary
+    path: str | None = None
+    fe: FitExtractor | None = None
+
+    def load(self) -> dict[str, pd.DataFrame]:
+        """Gets the message dataframes by name, loading them and removing their pickle file if they were spilled"""
+        if self.fe is not None:
+            return {name: self.fe.get_message_df(name) for name in self.summary.infos}
+        with open(self.path, 'rb') as f:
+            message_dfs = pickle.load(f)
+        os.remove(self.path)
+        return message_dfs
 
 class MultiFitProcessor:
     """Get data from multiple .fit files into a DB.
@@ -24,6 +119,25 @@ class MultiFitProcessor:
     def __init__(self, files: list[str], multiprocessing: bool = True) -> None:  
         self._multiprocessing: bool = multiprocessing
         self._fes: list[FitExtractor] = [FitExtractor(file) for file in files]
+        self._pool: multiprocessing.pool.Pool | None = None
+        self._engine: sqlalchemy.Engine | None = None
+
+    def __enter__(self) -> 'MultiFitProcessor':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __del__(self) -> None:
+        if getattr(self, '_pool', None) is not None:
+            self._pool.terminate()
+
+    def _terminate_pool(self) -> None:
+        """Stops the workers mid-task, the DB rolls back the transactions they had open"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
 
     @property
     def fes(self) -> list[FitExtractor]:
@@ -34,20 +148,84 @@ class MultiFitProcessor:
     def fes(self, value):
         self._fes = value
 
+    def close(self) -> None:
+        """Shuts down the worker pool and closes the DB connections, if they were started"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._engine is not None:
+            self._engine.dispose()
+            self._engine = None
+
+    def _new_pool(self) -> multiprocessing.pool.Pool:
+        context = multiprocessing.get_context('fork') if sys.platform != 'win32' else multiprocessing.get_context()
+        return context.Pool(os.cpu_count())
+
+    def _get_pool(self) -> multiprocessing.pool.Pool:
+        """Worker pool, created on first use and kept alive across processing phases until close()"""
+        if self._pool is None:
+            self._pool = self._new_pool()
+        return self._pool
+
+    def _chunksize(self, n: int) -> int:
+        """Tasks sent to a worker at a time, ~4 chunks per worker to balance pickling overhead and load"""
+        return max(1, math.ceil(n / (os.cpu_count() * 4)))
+
+    def _use_pool(self, n: int) -> bool:
+        """Whether n tasks are worth sending to the worker pool, starting workers costs more than a few tasks"""
+        if not self._multiprocessing:
+            return False
+        if n <= SERIAL_MAX_TASKS:
+            logger.debug("Skipping the worker pool: only %d tasks", n)
+            return False
+        if os.cpu_count() == 1:
+            logger.debug("Skipping the worker pool: single CPU")
+            return False
+        return True
+
     def _do_processing(self, inputs: tuple[tuple], function: t.Callable) -> list:
-        """Internal handler to either do things in parallel or loopy"""
-        if self._multiprocessing:
-            with Pool(os.cpu_count()) as pool:
-                res = pool.starmap(function, inputs)
-        else:
-            res = list(function(*input) for input in inputs)
-        return res
+        """Internal handler to either do things in parallel or loopy, the results are in the order of the inputs
+
+        The function is pickled for the workers, so it should not be bound to self (use a staticmethod).
+        """
+        return list(self._iter_processing(inputs, function, ordered=True))
     
-    def _process_single_manual(self, i: int, n: int, fe: FitExtractor) -> FitExtractor:
+    def _iter_processing(self, inputs: tuple[tuple], function: t.Callable, ordered: bool = False) -> t.Iterator:
+        """Like _do_processing, but yields the results as the workers finish them so they can be used while the rest is processed
+
+        Unless ordered, the results come in the order they complete.
+        """
+        inputs = tuple(inputs)
+        if self._use_pool(len(inputs)):
+            pool = self._get_pool()
+            imap = pool.imap if ordered else pool.imap_unordered
+            yield from imap(_call_star, ((function, input) for input in inputs), chunksize=self._chunksize(len(inputs)))
+        else:
+            yield from (function(*input) for input in inputs)
+
+    @staticmethod
+    def _process_single_manual(i: int, n: int, fe: FitExtractor) -> FitExtractor:
         fe.manual_process()
         print(f".fit {i+1:6.0f} / {n:<6.0f} processed")
         return fe
 
+    @staticmethod
+    def _parse_fit_file(i: int, n: int, fe: FitExtractor, spill_dir: str | None) -> ParsedFitFile:
+        """Processes a fit file and pickles its message dataframes to spill_dir, only the summary goes back to the parent.
+
+        The dataframes built for the summary are what the inserts need, the column buffers are left behind.
+        Without a spill_dir (parsing in process) the extractor is kept in the handle instead.
+        """
+        MultiFitProcessor._process_single_manual(i, n, fe)
+        summary = fe.summary
+        if spill_dir is None:
+            return ParsedFitFile(fe.file, fe.md5_hash, summary, fe=fe)
+        path = os.path.join(spill_dir, f'{i}.pickle')
+        with open(path, 'wb') as f:
+            pickle.dump({name: fe.get_message_df(name) for name in summary.infos}, f, pickle.HIGHEST_PROTOCOL)
+        return ParsedFitFile(fe.file, fe.md5_hash, summary, path)
+
     def process_all_manual(self) -> None:
         """Processes all fit files and generate the message data"""
         print("Processing all files:")
@@ -55,8 +233,8 @@ class MultiFitProcessor:
         return self._do_processing(tuple((i, n, fe) for i, fe in enumerate(self.fes)), self._process_single_manual)
 
     def get_message_names(self, fes: list[FitExtractor]) -> tuple[str]:
-        """Gets a list of the message names found in the loaded fit files"""
-        return tuple(set(name for fe in fes for name in fe.summary.names))
+        """Gets a list of the message names found in the loaded fit files, in the order they are first seen"""
+        return tuple(dict.fromkeys(name for fe in fes for name in fe.summary.infos))
     
     def get_message_types(self, fes: list[FitExtractor]) -> dict[str,dict[str,tuple[str]]]:
         """Gets a mapping of the message names to fields and their datatypes, by looking through all the loaded fit files.
@@ -75,32 +253,39 @@ class MultiFitProcessor:
             }
         }
         """
-        mns = self.get_message_names(fes)
-        res = {}
-        # Loop all message types
-        for mn in mns:
-            # Create df with cols as field names and rows as the dtypes of each file that has this message type
-            mtypes = pd.DataFrame(tuple(fe.summary.infos[mn].type_map for fe in fes if mn in fe.summary.infos))
-            # Create set with all unique not na types
-            res[mn] = {col: tuple(set(mtypes[col].dropna().values)) for col in mtypes.columns.values}
-        return res
+        res = collections.defaultdict(lambda: collections.defaultdict(set))
+        # Collect the set of seen types per message field, in one pass over the summaries
+        for fe in fes:
+            for mn, info in fe.summary.infos.items():
+                agg = res[mn]
+                for field, dtype in info.type_map.items():
+                    agg[field].add(dtype)
+        return {mn: {field: tuple(dtypes) for field, dtypes in fields.items()} for mn, fields in res.items()}
     
-    def _assign_field_sql_dtype(self, types) -> sqlalchemy.types.TypeEngine:
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _classify_dtype(type: str) -> tuple[int, sqlalchemy.types.TypeEngine | None]:
+        """The SQL type of a dtype name and its priority (index in SQL_TYPE_PRIORITY), (-1, None) if it has none"""
+        dtype = pd.api.types.pandas_dtype(type)
+        if isinstance(dtype, pd.StringDtype):
+            sql_type = sqlalchemy.types.Text # Kind 'O', but only holds str
+        elif isinstance(dtype, pd.CategoricalDtype):
+            sql_type = None
+        else:
+            sql_type = KIND_SQL_TYPES.get(dtype.kind)
+        return (SQL_TYPE_PRIORITY.index(sql_type), sql_type) if sql_type is not None else (-1, None)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _assign_field_sql_dtype(types: tuple[str]) -> sqlalchemy.types.TypeEngine:
         """Takes in a set of dtype names seen for a field across multiple extractors"""
-        TYPE_MAPPING = (
-            (pd.api.types.is_any_real_numeric_dtype, 'Double'),
-            (pd.api.types.is_datetime64_any_dtype, 'DateTime'),
-            (pd.api.types.is_string_dtype, 'Text'),
-            (pd.api.types.is_object_dtype, 'PickleType')
-        )
-        prio_res = 0
-        type_res = 'PickleType' # Default if none of above
-        for type in types: 
-            for prio, (fun, val) in enumerate(TYPE_MAPPING):
-                if prio >= prio_res and fun(type):
-                    type_res = val
-                    prio_res = prio
-        return getattr(sqlalchemy.types, type_res)
+        # Most fields have the same dtype in all files
+        if len(types) == 1 and types[0] in SINGLE_DTYPE_SQL_TYPES:
+            return SINGLE_DTYPE_SQL_TYPES[types[0]]
+
+        # The highest priority of the types, unclassified types don't count
+        _, sql_type = max((MultiFitProcessor._classify_dtype(type) for type in types), key=lambda c: c[0], default=(-1, None))
+        return sql_type if sql_type is not None else sqlalchemy.types.PickleType # Default if none of above
 
     def _generate_message_sql_dtype_map(self, fes: list[FitExtractor]) -> dict[str, dict[str, sqlalchemy.types.TypeEngine]]:
         """Gets a mapping of the message names to field and SQLAlchemy types, from all the loaded fit files.
@@ -122,38 +307,81 @@ class MultiFitProcessor:
 
         message_sql_dtype_map = {name: {field: self._assign_field_sql_dtype(field_types) for field, field_types in types[name].items()} for name in names}
 
+        # Timestamps that are not datetimes in some file, from the collected types instead of rereading the dataframes
         for n, m in message_sql_dtype_map.items():
-            if 'timestamp' in m:
-                if m['timestamp'] != sqlalchemy.types.DateTime:
-                    for fe in fes:
-                        if n in fe.summary.names:
-                            if fe.get_message_df(n).timestamp.dtype.name != 'datetime64[ns, UTC]': 
-                                print('asdf')
+            if 'timestamp' in m and m['timestamp'] != sqlalchemy.types.DateTime:
+                logger.warning("Message %s has non datetime timestamps: %s", n, types[n]['timestamp'])
 
         return message_sql_dtype_map
     
-    def _create_engine(self, db_url: str) -> sqlalchemy.Engine:
-        return sqlalchemy.create_engine(db_url)
+    @staticmethod
+    def _create_engine(db_url: str) -> sqlalchemy.Engine:
+        url = sqlalchemy.engine.make_url(db_url)
+        kwargs = dict(pool_pre_ping=True)
+        if url.get_backend_name() == 'postgresql':
+            kwargs.update(pool_size=os.cpu_count())
+        if url.get_dialect().driver == 'psycopg2':
+            # Executemany as multi-VALUES statements, with execute_batch for the rest
+            kwargs.update(executemany_mode='values_plus_batch', insertmanyvalues_page_size=INSERT_CHUNKSIZE)
+        return sqlalchemy.create_engine(db_url, **kwargs)
+
+    def _get_engine(self, db_url: str) -> sqlalchemy.Engine:
+        """Engine of this processor for the db url, kept with its connection pool until close() or another url is used"""
+        if self._engine is not None and self._engine.url != sqlalchemy.engine.make_url(db_url):
+            self._engine.dispose()
+            self._engine = None
+        if self._engine is None:
+            self._engine = self._create_engine(db_url)
+        return self._engine
     
-    def _drop_tables(self, db_url: str) -> None:
+    def _drop_tables(self, engine: sqlalchemy.Engine) -> None:
         "Drop the tables"
 
-        engine = self._create_engine(db_url)
-        
         with engine.connect() as con:
             con.commit()
 
         metadata = sqlalchemy.MetaData()
         metadata.reflect(bind=engine)
+
+        # Large objects are not removed with the table
+        fitfile_table = metadata.tables.get('fitfiles')
+        if fitfile_table is not None and isinstance(fitfile_table.c.blob.type, sqlalchemy.dialects.postgresql.OID):
+            with engine.connect() as con:
+                con.execute(sqlalchemy.select(sqlalchemy.func.lo_unlink(fitfile_table.c.blob)))
+                con.commit()
+
         metadata.drop_all(bind=engine)
 
-        engine.dispose()
+    def _add_foreign_keys(self, type_sql_map: dict, engine: sqlalchemy.Engine) -> None:
+        """Postgres - links the loaded message tables to fitfiles, checking each table once instead of every inserted row"""
+        if engine.dialect.name != 'postgresql':
+            return
+
+        quote = engine.dialect.identifier_preparer.quote
+        with engine.begin() as con:
+            for message_name in type_sql_map.keys():
+                t_name = f"message_{message_name}"
+                con.execute(sqlalchemy.text(
+                    f"ALTER TABLE {quote(t_name)} ADD CONSTRAINT {quote(t_name + '_fitfile_uuid_fkey')} "
+                    "FOREIGN KEY (fitfile_uuid) REFERENCES fitfiles (uuid)"))
+
+    @staticmethod
+    def _fitfile_table(meta: sqlalchemy.MetaData, sqlite: bool, blob_storage: str) -> sqlalchemy.Table:
+        """The fitfiles table, the index of the parsed files"""
+        uuid_sql_type = sqlalchemy.types.UUID if not sqlite else sqlalchemy.types.String(36)
+        return sqlalchemy.Table(
+            "fitfiles",
+            meta,
+            sqlalchemy.Column("uuid", uuid_sql_type, primary_key=True),
+            sqlalchemy.Column("filename", sqlalchemy.types.String(255), nullable=False),
+            sqlalchemy.Column("md5_hash", sqlalchemy.types.String(32), nullable=False),
+            sqlalchemy.Column("message_types", sqlalchemy.types.ARRAY(sqlalchemy.types.String(255)) if not sqlite else sqlalchemy.types.String(36), nullable=False),
+            sqlalchemy.Column("blob", BLOB_SQL_TYPES[blob_storage], nullable=False)
+        )
 
-    def _create_tables(self, type_sql_map: dict, db_url: str) -> sqlalchemy.Table:
+    def _create_tables(self, type_sql_map: dict, engine: sqlalchemy.Engine, blob_storage: str) -> sqlalchemy.Table:
         """Creates the required tables using the type mapping information"""
 
-        engine = self._create_engine(db_url)
-
         def print_table(t: sqlalchemy.Table) -> None:
             print(f"New table: {t.name}")
             for c in t.columns:
@@ -161,94 +389,238 @@ class MultiFitProcessor:
             print()
 
 
-        uuid_sql_type = sqlalchemy.types.UUID if 'sqlite' not in db_url else sqlalchemy.types.String(36)
+        sqlite = engine.dialect.name == 'sqlite'
+        uuid_sql_type = sqlalchemy.types.UUID if not sqlite else sqlalchemy.types.String(36)
 
         meta = sqlalchemy.MetaData()
-        fitfile_table = sqlalchemy.Table(
-            "fitfiles",
-            meta,
-            sqlalchemy.Column("uuid", uuid_sql_type, primary_key=True),
-            sqlalchemy.Column("filename", sqlalchemy.types.String(255), nullable=False),
-            sqlalchemy.Column("md5_hash", sqlalchemy.types.String(32), nullable=False),
-            sqlalchemy.Column("message_types", sqlalchemy.types.ARRAY(sqlalchemy.types.String(255)) if 'sqlite' not in db_url else sqlalchemy.types.String(36), nullable=False),
-            sqlalchemy.Column("blob", sqlalchemy.types.LargeBinary, nullable=False)
-        )
-        fitfile_table.create(engine)
-        print_table(fitfile_table)
+        fitfile_table = self._fitfile_table(meta, sqlite, blob_storage)
 
         for message_name, field_types in type_sql_map.items():
             columns = tuple(sqlalchemy.Column(field, field_type) for field, field_type in field_types.items())
             t_name = f"message_{message_name}"
-            table = sqlalchemy.Table(
+            sqlalchemy.Table(
                 t_name,
                 meta,
-                sqlalchemy.Column("fitfile_uuid", uuid_sql_type, sqlalchemy.ForeignKey('fitfiles.uuid')),
+                # Postgres gets the foreign key after the load, see _add_foreign_keys - sqlite doesn't enforce it by default
+                sqlalchemy.Column("fitfile_uuid", uuid_sql_type, *((sqlalchemy.ForeignKey('fitfiles.uuid'),) if sqlite else ())),
                 sqlalchemy.Column('index', sqlalchemy.types.BIGINT),
                 *columns)
-            table.create(engine)
+
+        # All the tables in one transaction
+        meta.create_all(engine, checkfirst=False)
+        for table in meta.sorted_tables:
             print_table(table)
-        
-        engine.dispose()
 
         return fitfile_table
 
-    def _add_fit_message_data_to_table(self, i: int, n: id, fe: FitExtractor, type_sql_map: dict, fitfile_table: sqlalchemy.Table, db_url: str) -> None:
-        """The meat and potatoes - take a fit extractor and load to DB """
-        
-        engine = self._create_engine(db_url)
-
-        with open(fe.file, 'rb') as f:
-            data_blob = f.read()
+    @staticmethod
+    def _extract_fit_message_data(i: int, n: int, parsed: ParsedFitFile, type_sql_map: dict, db_url: str) -> tuple[dict, dict[str, pd.DataFrame]]:
+        """Collects the fitfiles row and the message dataframes of a parsed fit file, no DB writes"""
 
         fitfile_uuid = uuid.uuid4()
+        if 'sqlite' in db_url:
+            fitfile_uuid = str(fitfile_uuid)
 
-        statement = fitfile_table.insert().values(
-                        uuid=fitfile_uuid if 'sqlite' not in db_url else str(fitfile_uuid),
-                        filename=fe.file.split('/')[-1],
-                        md5_hash=fe.md5_hash,
-                        message_types=fe.summary.names if 'sqlite' not in db_url else str(fe.summary.names),
-                        blob = data_blob
-                    )
-        
-        with engine.connect() as con:
-            con.execute(statement)
-            con.commit()
+        names = parsed.summary.names
 
-        for message_name, dtype_map in type_sql_map.items():
-            if message_name in fe.summary.names:
+        fitfile_row = dict(
+            uuid=fitfile_uuid,
+            filename=os.path.basename(parsed.file),
+            md5_hash=parsed.md5_hash,
+            message_types=names if 'sqlite' not in db_url else str(names),
+            blob=parsed.file # The file is mapped when the row is inserted, see _map_blob
+        )
+
+        parsed_dfs = parsed.load()
+        message_dfs = {}
+        # The file's own messages, looked up in the type map dict - no scan of the message names per table
+        for message_name, info in parsed.summary.infos.items():
+            # Messages without rows have nothing to insert
+            if info.num_messages and message_name in type_sql_map:
+                message_dfs[message_name] = parsed_dfs[message_name].assign(fitfile_uuid=fitfile_uuid)
+
+        print(f".fit {i+1:6.0f} / {n:<6.0f} extracted")
+        return fitfile_row, message_dfs
+
+    @staticmethod
+    def _copy_df_to_table(df: pd.DataFrame, table_name: str, dtype_map: dict, con: sqlalchemy.Connection) -> None:
+        """Postgres through psycopg2 only - writes the dataframe, and its index, with COPY FROM STDIN as csv. Much faster than INSERTs."""
+        quote = con.dialect.identifier_preparer.quote
+
+        # Values as the text input formats of the column types
+        df = df.copy(deep=False)
+        for field, field_type in dtype_map.items():
+            if field not in df.columns:
+                continue
+            if field_type is sqlalchemy.types.PickleType:
+                # bytea hex format, the same pickles as the PickleType column would make
+                mask = df[field].isna()
+                df[field] = ['\\x' + pickle.dumps(v, pickle.HIGHEST_PROTOCOL).hex() if not na else None for v, na in zip(df[field], mask)]
+            elif pd.api.types.is_datetime64_any_dtype(df[field]) and df[field].dt.tz is not None:
+                df[field] = df[field].dt.tz_convert('UTC').dt.tz_localize(None)
+
+        buf = io.StringIO()
+        df.to_csv(buf, header=False, na_rep='\\N', date_format='%Y-%m-%d %H:%M:%S.%f')
+        buf.seek(0)
+
+        columns = ', '.join(quote(c) for c in ('index', *df.columns))
+        cursor = con.connection.cursor()
+        cursor.copy_expert(f"COPY {quote(table_name)} ({columns}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')", buf)
+        cursor.close()
+
+    @staticmethod
+    def _sqlite_max_variables(con: sqlalchemy.Connection) -> int:
+        """Bound variables per statement the sqlite connection takes, limits the rows per multi-row INSERT"""
+        dbapi_con = con.connection.dbapi_connection
+        if hasattr(dbapi_con, 'getlimit'): # Python >= 3.11
+            return dbapi_con.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        return SQLITE_MAX_VARIABLES if sqlite3.sqlite_version_info >= (3, 32) else SQLITE_OLD_MAX_VARIABLES
+
+    @staticmethod
+    def _map_blob(file: str, stack: contextlib.ExitStack) -> mmap.mmap | bytes:
+        """Memory maps the fit file for the blob column, instead of reading a copy in to memory. Unmapped when the stack exits."""
+        with open(file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b'' # Empty files can't be mapped
+            return stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @staticmethod
+    def _copy_blob_file(file: str, md5_hash: str, blob_dir: str) -> str:
+        """Copies the fit file in to blob_dir, named by its hash so each file is stored once. Returns the path."""
+        path = os.path.abspath(os.path.join(blob_dir, f'{md5_hash}.fit'))
+        if not os.path.exists(path):
+            # Through a temporary name, workers can store the same file at the same time
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            shutil.copyfile(file, tmp_path)
+            os.replace(tmp_path, path)
+        return path
+
+    @staticmethod
+    def _add_fit_message_data_to_table(i: int, n: int, fitfile_row: dict, message_dfs: dict[str, pd.DataFrame], type_sql_map: dict, fitfile_table: sqlalchemy.Table, engine: sqlalchemy.Engine, blob_storage: str, blob_dir: str | None = None) -> int:
+        """The meat and potatoes - load the extracted data of a fit file to DB, one write per message table. Returns the number of message rows inserted."""
+
+        # Postgres through psycopg2 gets the rows with COPY (copy_expert is psycopg2 only), others many rows per INSERT statement instead of one round-trip per row
+        copy = engine.dialect.driver == 'psycopg2'
+        sqlite = engine.dialect.name == 'sqlite'
+
+        num_rows = 0
+        # All in one transaction, one commit for the file
+        with contextlib.ExitStack() as blobs, engine.begin() as con:
+            # The fitfiles row goes first, the message rows reference it
+            if blob_storage == 'file':
+                blob = MultiFitProcessor._copy_blob_file(fitfile_row['blob'], fitfile_row['md5_hash'], blob_dir)
+            else:
+                blob = MultiFitProcessor._map_blob(fitfile_row['blob'], blobs)
+
+            if blob_storage == 'large_object':
+                # Written through the binary large object interface, the blob column gets the oid
+                lobj = con.connection.dbapi_connection.lobject(0, 'wb')
+                for start in range(0, len(blob), LOBJECT_CHUNKSIZE):
+                    lobj.write(blob[start:start + LOBJECT_CHUNKSIZE])
+                blob = lobj.oid
+                lobj.close()
+
+            con.execute(fitfile_table.insert(), dict(fitfile_row, blob=blob))
+
+            max_variables = MultiFitProcessor._sqlite_max_variables(con) if sqlite else None
+
+            for message_name, dtype_map in type_sql_map.items():
+                df = message_dfs.get(message_name)
+                if df is None or not df.shape[0]:
+                    continue
+
+                # As many rows as sqlite takes variables for, the index is a column too
+                chunksize = min(INSERT_CHUNKSIZE, max(1, max_variables // (df.shape[1] + 1))) if sqlite else INSERT_CHUNKSIZE
                 try:
-                    df = fe.get_message_df(message_name)
-                    df["fitfile_uuid"] = fitfile_uuid if 'sqlite' not in db_url else str(fitfile_uuid)
-                    df.to_sql('message_' + message_name, engine, if_exists="append", dtype=dtype_map)
+                    # A failed message table is rolled back to the savepoint, the rest of the file still goes in
+                    with con.begin_nested():
+                        if copy:
+                            MultiFitProcessor._copy_df_to_table(df, 'message_' + message_name, dtype_map, con)
+                        else:
+                            df.to_sql('message_' + message_name, con, if_exists="append", dtype=dtype_map, method='multi', chunksize=chunksize)
+                    num_rows += df.shape[0]
                     print(f".fit {i+1:6.0f} / {n:<6.0f} {df.shape[0]:6.0f} rows -> {message_name}")
                 except Exception as e:
-                    print(f".fit {i+1:6.0f} / {n:<6.0f} {df.shape[0]:6.0f} ERROR IN DB INSERT")
+                    print(f".fit {i+1:6.0f} / {n:<6.0f} {df.shape[0]:6.0f} ERROR IN DB INSERT -> {message_name}")
                     print('-'*50)
                     print(e)
                     print('-'*50)
-        
-        engine.dispose()
 
-    def to_db(self, db_url: str = DEFAULT_DB_URL, drop_tables: bool = False) -> None:
-        """Processes the loaded fit files and insert in DB"""
-        
-        print("Preprocessing files to get data type information for table creation\n")
-        fes_proc = self.process_all_manual()
+        return num_rows
+
+    @staticmethod
+    def _load_fit_file(i: int, n: int, parsed: ParsedFitFile, type_sql_map: dict, db_url: str, blob_storage: str, blob_dir: str | None,
+                       engine: sqlalchemy.Engine | None = None) -> int:
+        """Inserts the data of a parsed fit file. Returns the number of message rows inserted.
 
-        print("Creating table type maps...")
-        type_sql_map = self._generate_message_sql_dtype_map(fes_proc)
+        Without an engine, in a pool worker, the worker's own is used - see _get_process_engine.
+        """
+        if engine is None:
+            engine = _get_process_engine(db_url)
+        fitfile_row, message_dfs = MultiFitProcessor._extract_fit_message_data(i, n, parsed, type_sql_map, db_url)
+        fitfile_table = MultiFitProcessor._fitfile_table(sqlalchemy.MetaData(), engine.dialect.name == 'sqlite', blob_storage)
 
-        # Dropping tables - if desired
-        if drop_tables:
-            self._drop_tables(db_url)
+        return MultiFitProcessor._add_fit_message_data_to_table(i, n, fitfile_row, message_dfs, type_sql_map, fitfile_table, engine, blob_storage, blob_dir)
 
-        # Create data tables
-        file_table = self._create_tables(type_sql_map, db_url)
+    def to_db(self, db_url: str = DEFAULT_DB_URL, drop_tables: bool = False, blob_storage: str = 'db', blob_dir: str | None = None) -> None:
+        """Processes the loaded fit files and insert in DB
 
-        # Load in the data
-        print("Start inserting data in tables")
-        n = len(fes_proc)
-        res = self._do_processing(((i, n, fe, type_sql_map, file_table, db_url) for i, fe in enumerate(fes_proc)), self._add_fit_message_data_to_table)
+        blob_storage sets where the raw fit files go:
+            'db': in the fitfiles.blob column
+            'large_object': as postgres large objects, fitfiles.blob has their oid (postgres through psycopg2 only)
+            'file': copied to blob_dir as <md5_hash>.fit, fitfiles.blob has their path
+        """
+        if blob_storage not in BLOB_STORAGES:
+            raise Exception(f'blob_storage must be one of {BLOB_STORAGES}')
+
+        # One engine for the table setup, kept between to_db calls - the workers insert with their own
+        engine = self._get_engine(db_url)
+
+        # The large objects are written with psycopg2's lobject
+        if blob_storage == 'large_object' and engine.dialect.driver != 'psycopg2':
+            raise Exception('Large object blob storage requires postgres with the psycopg2 driver')
+        if blob_storage == 'file':
+            if blob_dir is None:
+                raise Exception('File blob storage requires a blob_dir')
+            os.makedirs(blob_dir, exist_ok=True)
+        
+        n = len(self.fes)
+        # Files parsed by the workers wait on disk for the inserts, instead of all of them in memory.
+        # Parsed in process they are in self.fes already, so there is nothing to save by spilling them.
+        spill = self._use_pool(n)
+        with tempfile.TemporaryDirectory(prefix='fitextractor_') if spill else contextlib.nullcontext() as spill_dir:
+            print("Preprocessing files to get data type information for table creation\n")
+            print("Processing all files:")
+            parsed = self._do_processing(tuple((i, n, fe, spill_dir) for i, fe in enumerate(self.fes)), self._parse_fit_file)
+
+            print("Creating table type maps...")
+            type_sql_map = self._generate_message_sql_dtype_map(parsed)
+
+            # Dropping tables - if desired
+            if drop_tables:
+                self._drop_tables(engine)
+
+            # Create data tables
+            self._create_tables(type_sql_map, engine, blob_storage)
+
+            # Each file is extracted and inserted by one worker of the pool, with the settings sent along.
+            # sqlite takes one writer at a time, so like a small or serial run it stays in this process on the processor's engine.
+            print("Extracting message data and inserting in tables")
+            inputs = tuple((i, n, p, type_sql_map, db_url, blob_storage, blob_dir) for i, p in enumerate(parsed))
+            if engine.dialect.name != 'sqlite' and self._use_pool(n):
+                res = self._iter_processing(inputs, self._load_fit_file)
+            else:
+                res = (self._load_fit_file(*input, engine) for input in inputs)
+            try:
+                num_rows = sum(res)
+            except BaseException:
+                # The workers still loading other files would race the keys for the table locks, and need the spill files removed below
+                self._terminate_pool()
+                raise
+            finally:
+                # Also when a file fails, the ones loaded are whole (a transaction each) - and a rerun without drop_tables stops at the table creation
+                self._add_foreign_keys(type_sql_map, engine)
+            print(f"{n} .fit files, {num_rows} message rows inserted")
     
 if __name__ == '__main__':
    pass
\ No newline at end of file
@@ -9,6 +9,13 @@ from setuptools import setup, find_packages
 def read(fname):
     return open(os.path.join(os.path.dirname(__file__), fname)).read()
 
+# Optionally compile the parsing hot loop with mypyc: FITEXTRACTOR_USE_MYPYC=1 pip install .
+# Without it the same module runs as plain python.
+ext_modules = []
+if os.environ.get('FITEXTRACTOR_USE_MYPYC') == '1':
+    from mypyc.build import mypycify
+    ext_modules = mypycify(['--follow-imports=skip', 'fitextractor/_fitextract_core.py'])
+
 setup(
     name = "fitextractor",
     version = "0.0.2",
@@ -19,6 +26,7 @@ setup(
     keywords = "database fitness fit",
     url = "https://github.com/jonasinn/fitextractor",
     packages=find_packages(),
+    ext_modules=ext_modules,
     install_requires=[
         'fitdecode>=0.10',
         'numpy>=1.2',
@@ -26,6 +34,9 @@ setup(
         'SQLAlchemy>=2.0',
         'psycopg2>=2.9'
     ],
+    extras_require={
+        'pyarrow': ['pyarrow']
+    },
     long_description=read('README.md'),
     classifiers=[
         "Development Status :: 3 - Alpha",
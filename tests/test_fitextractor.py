@@ -1,9 +1,14 @@
 
+import math
+import array
+import pickle
+import hashlib
 import unittest
 
 import fitdecode
 
 from fitextractor import *
+from fitextractor._fitextract_core import new_column, append_value
 
 
 class TestFitExtractor(unittest.TestCase):
@@ -20,4 +25,72 @@ class TestFitExtractor(unittest.TestCase):
 
         self.assertTrue(isinstance(fe.header, fitdecode.records.FitHeader))
         self.assertTrue(isinstance(fe.crc, fitdecode.records.FitCRC))
-        self.assertTrue(len(messages.keys()) > 0)
\ No newline at end of file
+        self.assertTrue(len(messages.keys()) > 0)
+
+    def test_message_columns_aligned(self):
+        fe = FitExtractor(self.files[0])
+
+        for name, columns in fe.messages.items():
+            lengths = set(len(column) for column in columns.values())
+            self.assertTrue(len(lengths) <= 1)
+            self.assertEqual(set(columns.keys()), set(fe.units[name].keys()))
+
+        df = fe.get_message_df('record')
+        self.assertEqual(df.shape[0], len(fe.messages['record']['timestamp']))
+
+    def test_column_widening(self):
+        column = append_value(new_column(1, 0), 1)
+        self.assertEqual(column.typecode, 'q')
+
+        column = append_value(column, None)
+        self.assertEqual(column.typecode, 'd')
+        self.assertTrue(math.isnan(column[-1]))
+
+        column = append_value(column, 'garmin')
+        self.assertEqual(column, [1.0, None, 'garmin'])
+
+        self.assertEqual(new_column('garmin', 2), [None, None])
+        self.assertIsInstance(FitExtractor(self.files[0]).messages['record']['heart_rate'], array.array)
+
+    def test_message_unit_df(self):
+        fe = FitExtractor(self.files[0])
+        df = fe.get_message_df('record', 'unit')
+
+        self.assertEqual(df.shape[0], fe.get_message_df('record').shape[0])
+        self.assertTrue((df['heart_rate'] == 'bpm').all())
+
+    def test_message_df_cached(self):
+        fe = FitExtractor(self.files[0])
+        fe.summary
+
+        self.assertIs(fe.get_message_df('record'), fe.get_message_df('record'))
+        self.assertIsNot(fe.get_message_df('record'), fe.get_message_df('record', 'raw_value'))
+
+    def test_pickle(self):
+        fe = FitExtractor(self.files[0])
+        fe.summary
+        fe_copy = pickle.loads(pickle.dumps(fe))
+
+        self.assertEqual(fe_copy._df_cache, {})
+        self.assertEqual(fe_copy.summary, fe.summary)
+        self.assertTrue(fe_copy.get_message_df('record').equals(fe.get_message_df('record')))
+
+    def test_md5_hash(self):
+        fe = FitExtractor(self.files[0])
+        with open(self.files[0], 'rb') as f:
+            self.assertEqual(fe.md5_hash, hashlib.md5(f.read()).hexdigest())
+
+    def test_parsing_bytes(self):
+        with open(self.files[0], 'rb') as f:
+            data = f.read()
+        fe = FitExtractor(data)
+
+        self.assertEqual(fe.md5_hash, FitExtractor(self.files[0]).md5_hash)
+        self.assertEqual(fe.summary.names, FitExtractor(self.files[0]).summary.names)
+
+    def test_parsing_stream(self):
+        with open(self.files[0], 'rb') as f:
+            fe = FitExtractor(f)
+            self.assertEqual(fe.md5_hash, FitExtractor(self.files[0]).md5_hash)
+            self.assertEqual(fe.summary.names, FitExtractor(self.files[0]).summary.names)
+            self.assertEqual(f.tell(), 0)
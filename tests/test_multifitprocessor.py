@@ -0,0 +1,132 @@
+
+import os
+import glob
+import hashlib
+import tempfile
+import unittest
+import collections
+from unittest import mock
+
+import sqlalchemy
+
+from fitextractor import *
+from fitextractor.multifitprocessor import SERIAL_MAX_TASKS
+
+# Postgres to test against, the postgres tests are skipped without it
+TEST_PG_URL = os.environ.get('FITEXTRACTOR_TEST_PG_URL')
+
+
+class TestMultiFitProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.files = sorted(glob.glob('tests/test_files/f*.fit'))
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.db_url = 'sqlite:///' + os.path.join(self.tmp_dir, 'fitdata.db')
+
+    def to_db(self, multiprocessing: bool = False, **kwargs) -> sqlalchemy.Engine:
+        with MultiFitProcessor(self.files, multiprocessing=multiprocessing) as mfp:
+            mfp.to_db(self.db_url, drop_tables=True, **kwargs)
+        engine = sqlalchemy.create_engine(self.db_url)
+        self.addCleanup(engine.dispose)
+        return engine
+
+    def assertRowCounts(self, engine):
+        expected = collections.Counter()
+        for file in self.files:
+            for name, info in FitExtractor(file).summary.infos.items():
+                expected[f'message_{name}'] += info.num_messages
+
+        message_tables = [name for name in sqlalchemy.inspect(engine).get_table_names() if name.startswith('message_')]
+        self.assertEqual(set(message_tables), set(expected))
+        with engine.connect() as con:
+            self.assertEqual(con.execute(sqlalchemy.text('SELECT count(*) FROM fitfiles')).scalar(), len(self.files))
+            for name in message_tables:
+                self.assertEqual(con.execute(sqlalchemy.text(f'SELECT count(*) FROM "{name}"')).scalar(), expected[name], name)
+
+    def read_files(self) -> dict[str, bytes]:
+        data = {}
+        for file in self.files:
+            with open(file, 'rb') as f:
+                data[os.path.basename(file)] = f.read()
+        return data
+
+    def test_to_db_blob_db(self):
+        engine = self.to_db()
+        self.assertRowCounts(engine)
+
+        data = self.read_files()
+        with engine.connect() as con:
+            for filename, md5_hash, blob in con.execute(sqlalchemy.text('SELECT filename, md5_hash, blob FROM fitfiles')):
+                self.assertEqual(blob, data[filename])
+                self.assertEqual(md5_hash, hashlib.md5(data[filename]).hexdigest())
+
+    def test_to_db_blob_file(self):
+        blob_dir = os.path.join(self.tmp_dir, 'blobs')
+        engine = self.to_db(blob_storage='file', blob_dir=blob_dir)
+        self.assertRowCounts(engine)
+
+        data = self.read_files()
+        with engine.connect() as con:
+            for filename, md5_hash, blob in con.execute(sqlalchemy.text('SELECT filename, md5_hash, blob FROM fitfiles')):
+                self.assertEqual(blob, os.path.join(os.path.abspath(blob_dir), f'{md5_hash}.fit'))
+                with open(blob, 'rb') as f:
+                    self.assertEqual(f.read(), data[filename])
+
+    def test_to_db_spilled(self):
+        self.assertGreater(len(self.files), SERIAL_MAX_TASKS)
+        spill_files = {}
+
+        class SpillDirectory(tempfile.TemporaryDirectory):
+            def cleanup(self):
+                spill_files[self.name] = os.listdir(self.name)
+                super().cleanup()
+
+        # The pool is used on single CPU machines too
+        with mock.patch('os.cpu_count', return_value=2), mock.patch('tempfile.TemporaryDirectory', SpillDirectory):
+            engine = self.to_db(multiprocessing=True)
+        self.assertRowCounts(engine)
+
+        # The loads removed the pickle files of the parse workers
+        self.assertEqual(list(spill_files.values()), [[]])
+
+
+@unittest.skipUnless(TEST_PG_URL, 'FITEXTRACTOR_TEST_PG_URL not set')
+class TestMultiFitProcessorPostgres(unittest.TestCase):
+
+    def setUp(self):
+        self.files = sorted(glob.glob('tests/test_files/f*.fit'))
+
+    def test_foreign_keys_after_failed_load(self):
+        extract = MultiFitProcessor._extract_fit_message_data
+
+        def failing_extract(i, *args):
+            if i == 2:
+                raise Exception('Failed extract')
+            return extract(i, *args)
+
+        for multiprocessing in (False, True):
+            with self.subTest(multiprocessing=multiprocessing):
+                # The patches are in place before the pool forks, the workers get them too
+                with mock.patch.object(MultiFitProcessor, '_extract_fit_message_data', staticmethod(failing_extract)), \
+                        mock.patch('os.cpu_count', return_value=2), \
+                        MultiFitProcessor(self.files, multiprocessing=multiprocessing) as mfp:
+                    with self.assertRaises(Exception):
+                        mfp.to_db(TEST_PG_URL, drop_tables=True)
+                    # The workers loading the other files were stopped
+                    self.assertIsNone(mfp._pool)
+
+                engine = sqlalchemy.create_engine(TEST_PG_URL)
+                inspector = sqlalchemy.inspect(engine)
+                message_tables = [name for name in inspector.get_table_names() if name.startswith('message_')]
+                self.assertTrue(message_tables)
+                for name in message_tables:
+                    self.assertEqual([fk['referred_table'] for fk in inspector.get_foreign_keys(name)], ['fitfiles'])
+                with engine.connect() as con:
+                    num_fitfiles = con.execute(sqlalchemy.text('SELECT count(*) FROM fitfiles')).scalar()
+                if multiprocessing:
+                    self.assertLess(num_fitfiles, len(self.files))
+                else:
+                    self.assertEqual(num_fitfiles, 2)
+                engine.dispose()